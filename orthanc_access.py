@@ -1,11 +1,19 @@
 import asyncio
-from collections import namedtuple
+from collections import defaultdict, namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hashlib
+import os
 from pathlib import Path
+import posixpath
+import re
 import subprocess
-from tempfile import gettempdir
+from tempfile import gettempdir, SpooledTemporaryFile
 import tomllib
+from typing import IO
 from zipfile import ZipFile
 
+from rich.text import Text
 from textual.app import App, ComposeResult
 from textual.containers import Horizontal
 from textual.widgets import (
@@ -18,17 +26,158 @@ from textual.widgets import (
 )
 from textual.worker import Worker, WorkerState
 
-import aiofiles
 import httpx
 import platformdirs
 
+Config = namedtuple(
+    "Config",
+    [
+        "orthanc_base_url",
+        "icf_image",
+        "store_base_dir",
+        "download_chunk_size",
+        "study_concurrency",
+        "icf_concurrency",
+        "checksum_header",
+    ],
+)
+
+
+@functools.lru_cache(maxsize=1)
+def _get_config() -> Config:
+    """Read configuration from a file in a standard location
+
+    The file is read once, and the result reused on later calls.
+
+    """
+
+    app = "orthanc_textual"
+    files = [
+        Path(d) / "config.toml"
+        for d in (
+            platformdirs.user_config_dir(app),
+            platformdirs.site_config_dir(app),
+        )
+    ]
+
+    for config_file in files:
+        try:
+            with config_file.open("rb") as f:
+                cfg = tomllib.load(f)
+            break
+        except FileNotFoundError:
+            continue
+    else:
+        msg = f"No config file found. Please create either of {files}."
+        raise RuntimeError(msg)
+
+    if "orthanc_base_url" not in cfg:
+        msg = f"orthanc_base_url is not set in {config_file}."
+        raise RuntimeError(msg)
+
+    # numeric settings, with their lower bound (None: may be left unset)
+    for key, default, minimum in (
+        ("download_chunk_size", 1024 * 1024, 1),
+        ("study_concurrency", 1, 1),
+        ("icf_concurrency", None, 1),
+    ):
+        value = cfg.get(key, default)
+        if value is None:
+            continue
+        if not isinstance(value, int) or isinstance(value, bool) or value < minimum:
+            msg = (
+                f"{key} must be an integer >= {minimum},"
+                f" got {value!r} in {config_file}."
+            )
+            raise RuntimeError(msg)
+
+    config = Config(
+        cfg["orthanc_base_url"],
+        Path(cfg["icf_image"]).expanduser(),
+        Path(cfg["store_base_dir"]).expanduser(),
+        cfg.get("download_chunk_size", 1024 * 1024),
+        cfg.get("study_concurrency", 1),
+        cfg.get("icf_concurrency"),
+        cfg.get("checksum_header"),
+    )
+    return config
+
+
+def _extract_zip(fileobj: IO[bytes], out_path: Path, max_workers: int = 8) -> None:
+    """Extract a zip file object into a given directory
+
+    Members are extracted by a pool of threads, sharing one ZipFile
+    (it serialises the reads from the underlying file itself), so
+    that decompression and writes of many small dicoms overlap.
+
+    Only file objects are accepted: given a path, ZipFile would own
+    the file and its (unlocked) reference counting could close it
+    while other threads are still reading.
+
+    """
+    if isinstance(fileobj, (str, os.PathLike)):
+        raise TypeError("_extract_zip needs a file object, not a path")
+
+    # zipfile does crc & inflate in C (zlib); libarchive would only
+    # extract into the cwd, unsafe with studies handled concurrently
+    with ZipFile(fileobj) as zf:
+        first, rest = [], []
+        seen_parents = set()
+        for info in zf.infolist():
+            parent = posixpath.dirname(info.filename)
+            if info.is_dir() or parent not in seen_parents:
+                first.append(info)
+                seen_parents.add(parent)
+            else:
+                rest.append(info)
+
+        # extract() creates missing directories, which would race
+        # between threads, so make sure they all exist beforehand
+        for info in first:
+            zf.extract(info, out_path)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(zf.extract, i, out_path) for i in rest]
+            for future in futures:
+                future.result()
+
+
+def _list_subdirs(path: Path) -> list[Path]:
+    """List subdirectories, using scandir to avoid a stat per entry"""
+    with os.scandir(path) as it:
+        return [Path(e.path) for e in it if e.is_dir(follow_symlinks=False)]
+
 
 class OrthancClient:
     """Interactions with the Orthanc API"""
 
-    def __init__(self, baseurl):
+    def __init__(self, baseurl, download_chunk_size=1024 * 1024, checksum_header=None):
         self.baseurl = baseurl
-        self.client = None
+
+        # endpoint urls, built once (%-templates take the orthanc id)
+        base = baseurl.replace("%", "%%")
+        self._url_system = f"{baseurl}/system"
+        self._url_find = f"{baseurl}/tools/find"
+        self._url_study = f"{base}/studies/%s"
+        self._url_archive = f"{base}/studies/%s/archive"
+        self._url_job = f"{base}/jobs/%s"
+        self._url_job_archive = f"{base}/jobs/%s/archive"
+        self.download_chunk_size = download_chunk_size
+        # response header with the archive's sha256, if there is one
+        self.checksum_header = checksum_header
+
+        # one client (and connection pool) reused for all calls
+        # http/2 (if offered via https) multiplexes the study queries
+        # no read / write timeout, archive downloads can take a while
+        self.client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+            timeout=httpx.Timeout(connect=10, read=None, write=None, pool=None),
+        )
+
+        # study metadata, keyed by orthanc study id, oldest first
+        self._study_cache: OrderedDict[str, dict] = OrderedDict()
+        self._study_cache_size = 4096
 
     async def login(self, user, password) -> None:
         """Check if credentials work and remember them
@@ -38,19 +187,22 @@ class OrthancClient:
         used for other calls. Raises an error if it fails.
 
         """
+        # what we can see may depend on who we are
+        self._study_cache.clear()
+
         if user == "" and password == "":
-            self.client = httpx.AsyncClient()
+            self.client.auth = None
         else:
-            self.client = httpx.AsyncClient(auth=(user, password))
+            self.client.auth = (user, password)
 
-        response = await self.client.get(f"{self.baseurl}/system")
+        response = await self.client.get(self._url_system)
         response.raise_for_status()
 
     async def query(self, date: str) -> list:
         """Perform a date query using /tools/find API
 
-        Runs the /tools/find query for a given StudyDate, and then a
-        /studies/{id} query to find matching PatientIDs.
+        Runs the /tools/find query for a given StudyDate, and then
+        (concurrent) /studies/{id} queries to find matching PatientIDs.
 
         Returns results as a list of (patientID, study_id) tuples (the
         first coming from dicom, the second being orthanc study ID),
@@ -66,47 +218,139 @@ class OrthancClient:
         }
 
         response = await self.client.post(
-            url=f"{self.baseurl}/tools/find",
+            url=self._url_find,
             json=d,
         )
         response.raise_for_status()
         matched_ids = response.json()
 
+        # fetch study details concurrently, but do not flood orthanc
+        semaphore = asyncio.Semaphore(16)
+
+        async def get_study(study_id):
+            async with semaphore:
+                return await self._get_study(study_id)
+
+        studies = await asyncio.gather(*(get_study(s) for s in matched_ids))
+
         results = []
-        for study_id in matched_ids:
-            response = await self.client.get(f"{self.baseurl}/studies/{study_id}")
-            d = response.json()
+        for study_id, d in zip(matched_ids, studies):
             patientID = d.get("PatientMainDicomTags", {}).get("PatientID")
             results.append((patientID, study_id))  # orthanc study id
 
         return results
 
+    async def _get_study(self, study_id: str) -> dict:
+        """Get study information using /studies/{id} API, with caching
+
+        Study metadata does not change once archived, so successful
+        responses are kept (up to a fixed number of studies, least
+        recently used ones are dropped first).
+
+        """
+        if study_id in self._study_cache:
+            self._study_cache.move_to_end(study_id)
+            return self._study_cache[study_id]
+
+        response = await self.client.get(self._url_study % study_id)
+        d = response.json()
+
+        if response.is_success:
+            self._study_cache[study_id] = d
+            if len(self._study_cache) > self._study_cache_size:
+                self._study_cache.popitem(last=False)
+
+        return d
+
+    async def _wait_for_job(self, job_id: str) -> None:
+        """Poll /jobs/{id} until the job succeeds
+
+        Polling interval starts low and doubles, up to a few seconds.
+        Raises an error if the job ends up in any state other than
+        those of a job still in progress (e.g. failed or paused).
+
+        """
+        delay = 0.5
+        while True:
+            response = await self.client.get(self._url_job % job_id)
+            response.raise_for_status()
+            job = response.json()
+            state = job["State"]
+
+            if state == "Success":
+                return
+            if state not in ("Pending", "Running", "Retry"):
+                desc = job.get("ErrorDescription")
+                msg = f"Orthanc job {job_id} did not succeed ({state}): {desc}"
+                raise RuntimeError(msg)
+
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 5)
+
     async def export(self, study_id: str) -> Path:
         """Export dicoms from Orthanc
 
-        Uses the /studies/{id}/archive API endpoint, unpacks and
-        removes the zipfile. Returns the path to the extracted
-        directory.
+        Creates the archive with an asynchronous job (POST to the
+        /studies/{id}/archive API endpoint), waits for the job to
+        finish, downloads the archive from /jobs/{id}/archive and
+        unpacks the zipfile, which is kept in a spooled temporary
+        file. Returns the path to the extracted directory.
 
         """
         outdir = Path(gettempdir())
-        zip_path = outdir.joinpath(f"{study_id}.zip")
         out_path = outdir.joinpath(f"{study_id}")
 
-        async with self.client.stream(
-            "GET", f"{self.baseurl}/studies/{study_id}/archive"
-        ) as r:
-            async with aiofiles.open(zip_path, "wb") as f:
-                async for chunk in r.aiter_bytes(chunk_size=10 * 1024):
-                    await f.write(chunk)
+        response = await self.client.post(
+            url=self._url_archive % study_id,
+            json={"Asynchronous": True},
+        )
+        response.raise_for_status()
+        job_id = response.json()["ID"]
+
+        await self._wait_for_job(job_id)
+
+        # hash while downloading, no need for another pass over the data
+        sha256 = hashlib.sha256() if self.checksum_header is not None else None
+
+        # keep the archive in memory, spill to disk only if it is large
+        with SpooledTemporaryFile(max_size=512 * 1024 * 1024) as f:
+
+            def write(chunk):
+                f.write(chunk)
+                if sha256 is not None:
+                    sha256.update(chunk)
+
+            async with self.client.stream("GET", self._url_job_archive % job_id) as r:
+                # e.g. 404 if orthanc already dropped the archive
+                r.raise_for_status()
+
+                if sha256 is not None:
+                    expected = r.headers.get(self.checksum_header)
+                    if expected is None:
+                        msg = (
+                            f"No {self.checksum_header} header in the archive"
+                            f" of study {study_id}, cannot verify it"
+                        )
+                        raise RuntimeError(msg)
 
-        with ZipFile(zip_path) as zf:
-            zf.extractall(out_path)
+                async for chunk in r.aiter_bytes(chunk_size=self.download_chunk_size):
+                    # once spilled to disk, writes would block the event loop
+                    await asyncio.to_thread(write, chunk)
 
-        zip_path.unlink()
+            if sha256 is not None:
+                if expected.lower() != sha256.hexdigest():
+                    msg = f"Checksum mismatch for archive of study {study_id}"
+                    raise RuntimeError(msg)
+
+            # extraction is blocking, keep it away from the event loop
+            await asyncio.to_thread(_extract_zip, f, out_path)
 
         return out_path
 
+    async def aclose(self) -> None:
+        """Close the underlying client and its connection pool"""
+        await self.client.aclose()
+
 
 class OrthancApp(App):
     """Textual app, with UI and logic for the Orthanc-ICF workflow"""
@@ -116,9 +360,32 @@ class OrthancApp(App):
 
     def __init__(self):
         super().__init__()
-        self.config = self._get_config()
-        self.orthanc = OrthancClient(self.config.orthanc_base_url)
+        self.config = _get_config()
+        self.orthanc = OrthancClient(
+            self.config.orthanc_base_url,
+            download_chunk_size=self.config.download_chunk_size,
+            checksum_header=self.config.checksum_header,
+        )
         self.listed_studies = {}
+        # messages waiting to be written to the log window
+        self._log_buffer = []
+        # passed to every icf call, convert once
+        self.store_dir = str(self.config.store_base_dir)
+        # one lock per (icf) study id, guarding its catalog
+        self._catalog_locks = defaultdict(asyncio.Lock)
+        # limit the number of icf processes running at the same time
+        self.icf_semaphore = asyncio.Semaphore(
+            self.config.icf_concurrency or os.cpu_count() or 1
+        )
+
+    def on_mount(self) -> None:
+        self.set_interval(0.1, self._flush_log)
+        # shared stdin for icf processes, instead of opening one each
+        self._devnull = os.open(os.devnull, os.O_RDWR)
+
+    async def on_unmount(self) -> None:
+        await self.orthanc.aclose()
+        os.close(self._devnull)
 
     def compose(self) -> ComposeResult:
         """Create child widgets for the app."""
@@ -139,89 +406,175 @@ class OrthancApp(App):
         yield RichLog(highlight=True, markup=True)
         yield Footer()
 
-    async def call_icf(self, cmd: str, *args) -> None:
-        """Helper to call ICF commands as asyncio subprocesses
+    def write_log(self, content) -> None:
+        """Queue content for the log window
 
-        Creates the subprocess, awaits its exit, and prints the result
-        (ok/error) in the log window.
+        Content is written by a periodic flush, so that bursts of
+        messages (e.g. command output) are rendered together.
 
         """
+        self._log_buffer.append(content)
+
+    def _flush_log(self) -> None:
+        """Write queued content to the log window"""
+        if not self._log_buffer:
+            return
+
         log = self.query_one(RichLog)
+        *head, last = self._log_buffer
+        self._log_buffer = []
 
-        # ignore stdin/out for now, just wait for process to exit
-        proc = await asyncio.create_subprocess_exec(
-            self.config.icf_image,
-            cmd,
-            *args,
-            stdin=subprocess.DEVNULL,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-        )
-        returncode = await proc.wait()
+        # scroll only once, after the last item
+        for content in head:
+            log.write(content, scroll_end=False)
+        log.write(last)
+
+    def _write_output(self, cmd: str, line: bytes) -> None:
+        """Show a line of command output in the log window"""
+        text = line.decode(errors="replace").rstrip()
+        if text != "":
+            # plain text, command output is not rich markup
+            self.write_log(Text(f"{cmd}: {text}"))
+
+    async def call_icf(self, cmd: str, *args) -> None:
+        """Helper to call ICF commands as asyncio subprocesses
+
+        Creates the subprocess (waiting for a free slot if too many
+        are running already), shows its output in the log window,
+        awaits its exit, and prints the result (ok/error).
+
+        """
+        async with self.icf_semaphore:
+            proc = await asyncio.create_subprocess_exec(
+                self.config.icf_image,
+                cmd,
+                *args,
+                stdin=self._devnull,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+            )
+            try:
+                # read chunks rather than lines: StreamReader's line limit
+                # would fail on long lines or \r-only progress output
+                pending = b""
+                while chunk := await proc.stdout.read(64 * 1024):
+                    *lines, pending = re.split(rb"[\r\n]", pending + chunk)
+                    if len(pending) > 64 * 1024:
+                        lines.append(pending)
+                        pending = b""
+                    for line in lines:
+                        self._write_output(cmd, line)
+                self._write_output(cmd, pending)
+                returncode = await proc.wait()
+            except asyncio.CancelledError:
+                # do not leave the container running unattended
+                if proc.returncode is None:
+                    proc.terminate()
+                await proc.wait()
+                raise
 
         if returncode == 0:
             msg = "[green]OK[/green]"
         else:
             msg = f"[red]ERROR {returncode}[/red]"
 
-        log.write(f"({msg}) {cmd}")
+        self.write_log(f"({msg}) {cmd}")
 
     async def icf_workflow(self, orthanc_study_ids: list) -> None:
         """Run the workflow: orthanc export, icf utils
 
-        Loops over all selected orthanc studies.
+        Exports the selected orthanc studies one by one and hands them
+        over (through a queue) to the icf utils, so that the next study
+        is being exported while the previous ones are processed. Up to
+        study_concurrency studies are processed at the same time.
 
         """
-        log = self.query_one(RichLog)
-
-        for s in orthanc_study_ids:
-            log.write(f"Processing dicom study id {s}")
-
-            # export dicoms from orthanc
-            export_dir = await self.orthanc.export(s)
-            log.write(f"Exported {export_dir}")
-
-            # work on subdirectory (<orthanc study id>/<subject ID> <subject name>)
-            subdirs = [child for child in export_dir.iterdir() if child.is_dir()]
-            assert len(subdirs) == 1
-            dicom_dir = subdirs[0]
-
-            # figure out study & visit ID from patient ID
-            study_id, visit_id = self._parse_id(self.listed_studies[s])
-
-            result = await self.call_icf(
-                "make_studyvisit_archive",
-                "--output-dir",  # psychoinformatics-de/inm-icf-utilities/issues/52
-                self.config.store_base_dir,
-                "--id",
-                study_id,
-                visit_id,
-                dicom_dir,
-            )
+        queue = asyncio.Queue(maxsize=2)
+
+        # the listing may change (new query) while we are working
+        patient_ids = {s: self.listed_studies[s] for s in orthanc_study_ids}
+        n_consumers = self.config.study_concurrency
+
+        export_error = None
+
+        async def produce():
+            nonlocal export_error
+            try:
+                for s in orthanc_study_ids:
+                    self.write_log(f"Processing dicom study id {s}")
+
+                    # export dicoms from orthanc
+                    export_dir = await self.orthanc.export(s)
+                    self.write_log(f"Exported {export_dir}")
+
+                    await queue.put((patient_ids[s], export_dir))
+            except Exception as e:
+                # raised once the studies already exported are done
+                export_error = e
+
+            # tell consumers there is nothing more to come
+            for _ in range(n_consumers):
+                await queue.put(None)
+
+        async def consume():
+            while (item := await queue.get()) is not None:
+                await self.process_study(*item)
+
+        # a task group cancels the remaining tasks if one of them fails
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(produce())
+            for _ in range(n_consumers):
+                tg.create_task(consume())
+
+        if export_error is not None:
+            raise export_error
+
+    async def process_study(self, patient_id: str, export_dir: Path) -> None:
+        """Run the icf utils for a single, exported orthanc study"""
+        # work on subdirectory (<orthanc study id>/<subject ID> <subject name>)
+        subdirs = await asyncio.to_thread(_list_subdirs, export_dir)
+        assert len(subdirs) == 1
+        dicom_dir = subdirs[0]
+
+        # figure out study & visit ID from patient ID
+        study_id, visit_id = self._parse_id(patient_id)
+
+        await self.call_icf(
+            "make_studyvisit_archive",
+            "--output-dir",  # psychoinformatics-de/inm-icf-utilities/issues/52
+            self.store_dir,
+            "--id",
+            study_id,
+            visit_id,
+            dicom_dir,
+        )
 
-            result = await self.call_icf(
-                "deposit_visit_metadata",
-                "--store-dir",
-                self.config.store_base_dir,
-                "--id",
-                study_id,
-                visit_id,
-            )
+        await self.call_icf(
+            "deposit_visit_metadata",
+            "--store-dir",
+            self.store_dir,
+            "--id",
+            study_id,
+            visit_id,
+        )
 
-            result = await self.call_icf(
-                "deposit_visit_dataset",
-                "--store-dir",
-                self.config.store_base_dir,
-                "--id",
-                study_id,
-                visit_id,
-                # todo: --store-url (once we know it)
-            )
+        await self.call_icf(
+            "deposit_visit_dataset",
+            "--store-dir",
+            self.store_dir,
+            "--id",
+            study_id,
+            visit_id,
+            # todo: --store-url (once we know it)
+        )
 
-            result = await self.call_icf(
+        # the catalog entry records the dataset deposited above; the
+        # study catalog is shared by all its visits, update one at a time
+        async with self._catalog_locks[study_id]:
+            await self.call_icf(
                 "catalogify_studyvisit_from_meta",
                 "--store-dir",
-                self.config.store_base_dir,
+                self.store_dir,
                 "--id",
                 study_id,
                 visit_id,
@@ -231,6 +584,7 @@ class OrthancApp(App):
         if event.input.id == "date_input":
             sl = self.get_child_by_id("sel_list")
             sl.clear_options()
+            self.listed_studies.clear()
 
             if event.input.value != "":
                 # orthanc sees "" as "any", but we are different
@@ -259,14 +613,12 @@ class OrthancApp(App):
             )
 
     def on_worker_state_changed(self, event: Worker.StateChanged) -> None:
-        log = self.query_one(RichLog)
-
         # login to orthanc (credentials check)
         if event.worker.name == "login":
             connect_button = self.get_widget_by_id("connect_button")
             date_input = self.get_widget_by_id("date_input")
             if event.state == WorkerState.SUCCESS:
-                log.write("Connected successfully")
+                self.write_log("Connected successfully")
                 date_input.disabled = False
                 connect_button.variant = "success"
             elif event.state == WorkerState.ERROR:
@@ -280,18 +632,18 @@ class OrthancApp(App):
                 sl = self.get_child_by_id("sel_list")
                 sl.add_options(event.worker.result)
                 # store the mapping for lookup later
-                self.listed_studies = {
-                    study_id: patientID for patientID, study_id in event.worker.result
-                }
+                self.listed_studies.update(
+                    (study_id, patientID) for patientID, study_id in event.worker.result
+                )
 
         elif event.worker.name == "icf_workflow":
             if event.state == WorkerState.SUCCESS:
-                log.write("[green]DONE[/green]")
+                self.write_log("[green]DONE[/green]")
 
         # do not let errors pass unnoticed
         if event.state == WorkerState.ERROR:
-            log.write(event)
-            log.write(event.worker.error)
+            self.write_log(event)
+            self.write_log(event.worker.error)
 
     def on_selection_list_selected_changed(
         self, event: SelectionList.SelectedChanged
@@ -322,38 +674,15 @@ class OrthancApp(App):
 
         return study, visit
 
-    def _get_config(self):
-        """Read configuration from a file in a standard location"""
-
-        app = "orthanc_textual"
-        files = [
-            Path(d) / "config.toml"
-            for d in (
-                platformdirs.user_config_dir(app),
-                platformdirs.site_config_dir(app),
-            )
-        ]
-
-        for config_file in files:
-            if config_file.is_file():
-                with config_file.open("rb") as f:
-                    cfg = tomllib.load(f)
-                break
-            else:
-                msg = f"No config file found. Please create either of {files}."
-                raise RuntimeError(msg)
-
-        Config = namedtuple(
-            "Config", ["orthanc_base_url", "icf_image", "store_base_dir"]
-        )
-        config = Config(
-            cfg.get("orthanc_base_url"),
-            Path(cfg["icf_image"]).expanduser(),
-            Path(cfg["store_base_dir"]).expanduser(),
-        )
-        return config
-
 
 if __name__ == "__main__":
+    # use the faster libuv-based event loop, if available
+    try:
+        import uvloop
+    except ImportError:
+        pass
+    else:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
     app = OrthancApp()
     app.run()